@@ -1,7 +1,66 @@
 # analysis.py
+import hashlib
 import numpy as np
 import pandas as pd
-import markdown
+
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+# Columns with negligible activity that are left out of the report
+NEGLIGIBLE_COLUMNS = ["Forwards", "Marked as spam"]
+
+# Raw count columns summed into the overall KPI table
+METRICS = ["Sent", "Delivered", "Opened", "Clicked", "Bounced", "Unsubscribes"]
+METRICS_SET = frozenset(METRICS)
+
+# Column labels for the rows returned by create_summary_table
+SUMMARY_COLUMNS = ("Metric", "Value", "Description")
+
+# (numerator, denominator, rate name) for every KPI rate, in report order
+RATE_SPECS = (
+    ("Delivered", "Sent", "Delivery Rate"),
+    ("Opened", "Delivered", "Open Rate"),
+    ("Clicked", "Delivered", "Click Rate"),
+    ("Bounced", "Sent", "Bounce Rate"),
+    ("Unsubscribes", "Sent", "Unsubscribe Rate"),
+)
+
+# Per-campaign rate columns added by compute_rate_columns
+RATE_COLUMNS = [rate_name for _, _, rate_name in RATE_SPECS]
+
+# Prompt inputs derived from df_rates, keyed by a fingerprint of the values they were computed from
+_DERIVED_CACHE = {}
+
+DESCRIPTIONS = {
+    "Sent": "Total emails sent",
+    "Delivered": "Emails delivered to inbox",
+    "Delivery Rate": "Percentage of sent emails delivered",
+    "Opened": "Total emails opened",
+    "Open Rate": "Percentage of delivered emails opened",
+    "Clicked": "Emails with clicks",
+    "Click Rate": "Percentage of delivered emails clicked",
+    "Bounced": "Emails that bounced",
+    "Bounce Rate": "Percentage of sent emails bounced",
+    "Unsubscribes": "Total unsubscribes",
+    "Unsubscribe Rate": "Percentage of sent emails unsubscribed",
+}
+
+def read_campaign_csv(path, skip_columns=NEGLIGIBLE_COLUMNS):
+    """
+    Reads a Zoho campaign export, using the multi-threaded pyarrow parser when it
+    is installed. Count columns are read as nullable integers so pandas skips
+    dtype inference for them, and skip_columns are never parsed at all.
+    Returns the DataFrame and the list of skip_columns that were present in the file.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    skipped = [col for col in skip_columns if col in header]
+    usecols = [col for col in header if col not in skipped]
+    df = pd.read_csv(path, engine=CSV_ENGINE, usecols=usecols,
+                     dtype={m: "Int64" for m in METRICS})
+    return df, skipped
 
 def create_summary_table(df):
     """
@@ -17,70 +76,105 @@ def create_summary_table(df):
       - Bounce Rate: Percentage of sent emails bounced.
       - Unsubscribes: Emails unsubscribed.
       - Unsubscribe Rate: Percentage of sent emails unsubscribed.
-    Returns the summary table as a DataFrame with columns: Metric, Value, Description.
-    """
-    total_sent = df["Sent"].sum() if "Sent" in df.columns else 0
-    total_delivered = df["Delivered"].sum() if "Delivered" in df.columns else 0
-    total_opened = df["Opened"].sum() if "Opened" in df.columns else 0
-    total_clicked = df["Clicked"].sum() if "Clicked" in df.columns else 0
-    total_bounced = df["Bounced"].sum() if "Bounced" in df.columns else 0
-    total_unsubscribes = df["Unsubscribes"].sum() if "Unsubscribes" in df.columns else 0
-
-    delivery_rate = (total_delivered / total_sent * 100) if total_sent > 0 else 0
-    open_rate = (total_opened / total_delivered * 100) if total_delivered > 0 else 0
-    click_rate = (total_clicked / total_delivered * 100) if total_delivered > 0 else 0
-    bounce_rate = (total_bounced / total_sent * 100) if total_sent > 0 else 0
-    unsubscribe_rate = (total_unsubscribes / total_sent * 100) if total_sent > 0 else 0
-
-    data = {
-        "Metric": ["Sent", "Delivered", "Delivery Rate", "Opened", "Open Rate", 
-                   "Clicked", "Click Rate", "Bounced", "Bounce Rate", "Unsubscribes", "Unsubscribe Rate"],
-        "Value": [total_sent,
-                  total_delivered,
-                  f"{delivery_rate:.2f}%",
-                  total_opened,
-                  f"{open_rate:.2f}%",
-                  total_clicked,
-                  f"{click_rate:.2f}%",
-                  total_bounced,
-                  f"{bounce_rate:.2f}%",
-                  total_unsubscribes,
-                  f"{unsubscribe_rate:.2f}%"],
-        "Description": [
-            "Total emails sent",
-            "Emails delivered to inbox",
-            "Percentage of sent emails delivered",
-            "Total emails opened",
-            "Percentage of delivered emails opened",
-            "Emails with clicks",
-            "Percentage of delivered emails clicked",
-            "Emails that bounced",
-            "Percentage of sent emails bounced",
-            "Total unsubscribes",
-            "Percentage of sent emails unsubscribed"
-        ]
-    }
-    summary_df = pd.DataFrame(data)
-    return summary_df
+    Returns the summary table as a list of (Metric, Value, Description) tuples.
+    """
+    present = METRICS_SET.intersection(df.columns)
+    sums = df[[m for m in METRICS if m in present]].sum(axis=0).to_dict()
+    totals = {m: sums.get(m, 0) for m in METRICS}
+    summary = [("Sent", totals["Sent"], DESCRIPTIONS["Sent"])]
+    for numerator, denominator, rate_name in RATE_SPECS:
+        denom = totals[denominator]
+        rate = f"{totals[numerator] / denom * 100:.2f}%" if denom > 0 else "0.00%"
+        summary.append((numerator, totals[numerator], DESCRIPTIONS[numerator]))
+        summary.append((rate_name, rate, DESCRIPTIONS[rate_name]))
+    return summary
+
+def format_summary_table(summary):
+    """
+    Renders the summary rows as aligned plain text for use in AI prompts.
+    """
+    rows = [SUMMARY_COLUMNS] + [tuple(str(cell) for cell in row) for row in summary]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(SUMMARY_COLUMNS))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
 
 def compute_rate_columns(df):
     """
-    Computes per-campaign rate columns.
+    Computes per-campaign rate columns from RATE_SPECS on the underlying NumPy
+    arrays, treating missing count columns as zero. A blank numerator gives a NaN
+    rate and a blank or zero denominator a 0 rate. Returns a new DataFrame holding
+    only the rate columns, aligned to df's index, so the input is never copied.
+    """
+    present = METRICS_SET.intersection(df.columns)
+    zeros = np.zeros(len(df), dtype=np.float64)
+    counts = {m: (df[m].to_numpy(dtype=np.float64, na_value=np.nan) if m in present else zeros)
+              for m in METRICS}
+    rates = {}
+    for numerator, denominator, rate_name in RATE_SPECS:
+        out = np.zeros(len(df), dtype=np.float64)
+        mask = counts[denominator] > 0
+        out[mask] = counts[numerator][mask] / counts[denominator][mask] * 100
+        rates[rate_name] = out
+    return pd.DataFrame(rates, index=df.index, copy=False)
+
+def correlation_matrix(df_rates):
+    """
+    Computes the correlation matrix between the per-campaign rate columns with a
+    single np.corrcoef call, falling back to pairwise DataFrame.corr when blank
+    counts left NaN rates. Returns the matrix and its column labels.
+    """
+    values = df_rates[RATE_COLUMNS].to_numpy(dtype=np.float64)
+    if np.isnan(values).any():
+        return df_rates[RATE_COLUMNS].corr().to_numpy(), list(RATE_COLUMNS)
+    # Constant columns have no defined correlation; leave them as NaN like DataFrame.corr
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr_mat = np.corrcoef(values, rowvar=False)
+    return corr_mat, list(RATE_COLUMNS)
+
+def format_correlation(corr_mat, corr_cols):
+    """
+    Renders the correlation matrix as compact CSV with three decimals for use in AI prompts.
+    """
+    frame = pd.DataFrame(corr_mat, index=corr_cols, columns=corr_cols)
+    return frame.to_csv(float_format="%.3f").rstrip("\n")
+
+def frame_fingerprint(df):
+    """
+    Returns a digest of the DataFrame's index and values, used to key memoized results.
+    """
+    hashes = pd.util.hash_pandas_object(df).to_numpy()
+    return hashlib.blake2b(hashes.tobytes(), digest_size=16, usedforsecurity=False).hexdigest()
+
+def dataset_fingerprint(df):
+    """
+    Returns a digest of the campaign names in the export, so cached AI commentary is
+    only reused for the same campaigns. None when there is no Campaign Name column.
+    """
+    if "Campaign Name" not in df.columns:
+        return None
+    return frame_fingerprint(df[["Campaign Name"]])
+
+def correlation_summary(df_rates):
+    """
+    Returns (corr_mat, corr_cols, corr_text) for the rate columns, computing the
+    matrix and its prompt text only once for a given set of rate values.
     """
-    df = df.copy()
-    df["Delivery Rate"] = np.where(df["Sent"] > 0, df["Delivered"] / df["Sent"] * 100, 0)
-    df["Open Rate"] = np.where(df["Delivered"] > 0, df["Opened"] / df["Delivered"] * 100, 0)
-    df["Click Rate"] = np.where(df["Delivered"] > 0, df["Clicked"] / df["Delivered"] * 100, 0)
-    df["Bounce Rate"] = np.where(df["Sent"] > 0, df["Bounced"] / df["Sent"] * 100, 0)
-    df["Unsubscribe Rate"] = np.where(df["Sent"] > 0, df["Unsubscribes"] / df["Sent"] * 100, 0)
-    return df
+    key = ("correlation", frame_fingerprint(df_rates[RATE_COLUMNS]))
+    if key not in _DERIVED_CACHE:
+        corr_mat, corr_cols = correlation_matrix(df_rates)
+        _DERIVED_CACHE[key] = (corr_mat, corr_cols, format_correlation(corr_mat, corr_cols))
+    return _DERIVED_CACHE[key]
 
-def process_markdown(text):
+def describe_rate(df_rates, metric):
     """
-    Converts markdown text to HTML.
+    Returns the count, mean, standard deviation, minimum and maximum of one rate
+    column as short text lines, memoized like correlation_summary.
     """
-    try:
-        html = markdown.markdown(text)
-        return html
-    except Exception as e:
-        return text
+    key = ("describe", metric, frame_fingerprint(df_rates[[metric]]))
+    if key not in _DERIVED_CACHE:
+        values = df_rates[metric]
+        _DERIVED_CACHE[key] = (f"count {values.count()}\n"
+                               f"mean {values.mean():.3f}\n"
+                               f"std {values.std():.3f}\n"
+                               f"min {values.min():.3f}\n"
+                               f"max {values.max():.3f}")
+    return _DERIVED_CACHE[key]
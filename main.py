@@ -1,24 +1,41 @@
 # main.py
 import os
 import argparse
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# Headless PDF pipeline: skip GUI backend detection and interactive redraws
+matplotlib.use("Agg")
+matplotlib.interactive(False)
 import matplotlib.pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
 from dotenv import load_dotenv
 
+# Load .env before the project modules read their settings at import time
+load_dotenv()
+
 # Import project modules
 import utils
 import analysis
 import visualization
-import openai
+import openai_integration
+
+plt.rcParams["path.simplify_threshold"] = 1.0
+plt.rcParams["agg.path.chunksize"] = 10000
+# Embed fonts as TrueType subsets rather than converting every glyph to a Type 3 procedure
+plt.rcParams["pdf.fonttype"] = 42
 
-load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-try:
-    import openai
-except ImportError:
-    openai = None
+def _lazy_openai():
+    """
+    Imports the OpenAI SDK on first use, so runs without an API key skip its import cost.
+    Returns None when the library is not installed.
+    """
+    try:
+        import openai
+    except ImportError:
+        utils.verbose_print("Please install the OpenAI library with `pip install openai`")
+        return None
+    return openai
 
 def main():
     parser = argparse.ArgumentParser(
@@ -28,78 +45,107 @@ def main():
                         help="Path to the CSV file (default: CampaignReports2025.csv)")
     parser.add_argument('--output', type=str, default="zoho_campaign_performance.pdf",
                         help="Output PDF file name (default: zoho_campaign_performance.pdf)")
+    parser.add_argument('--singlecore', action='store_true',
+                        help="Render chart slides in this process instead of a worker pool (for debugging)")
     args = parser.parse_args()
 
     utils.verbose_print("Initializing OpenAI client...")
-    client = utils.init_openai_client(openai, OPENAI_API_KEY)
+    client = utils.init_openai_client(_lazy_openai() if OPENAI_API_KEY else None, OPENAI_API_KEY)
 
     utils.verbose_print(f"Reading CSV file: {args.file}")
     try:
-        df = pd.read_csv(args.file)
+        df, dropped = analysis.read_campaign_csv(args.file)
         utils.verbose_print("CSV file loaded successfully.")
     except Exception as e:
         utils.verbose_print(f"Error reading file {args.file}: {e}")
         return
 
-    # Drop negligible columns if present
-    cols_to_drop = ["Forwards", "Marked as spam"]
-    dropped = []
-    for col in cols_to_drop:
-        if col in df.columns:
-            df.drop(columns=[col], inplace=True)
-            dropped.append(col)
     note = (f"Note: Dropped metrics: {', '.join(dropped)}." 
             if dropped else "Note: No negligible metrics were dropped.")
     utils.verbose_print(note)
 
-    with PdfPages(args.output) as pdf:
-        # Title Slide
-        utils.verbose_print("Generating title slide...")
-        fig, ax = plt.subplots(figsize=(11, 8.5))
-        utils.place_logo_on_figure(fig)
-        ax.axis('off')
-        ax.set_title("Zoho Campaign Performance", fontsize=30, color=utils.UCSB_BLUE, pad=20)
-        ax.text(0.5, 0.55, "A Data-Driven Look at Email Marketing Results", fontsize=18, ha='center', color=utils.PACE_LINKS)
-        utils.add_slide_number(fig)
-        pdf.savefig(fig, bbox_inches='tight')
-        plt.close(fig)
-
-        # Definitions Slide
-        utils.verbose_print("Generating definitions slide...")
-        visualization.create_definitions_additional_slide(pdf, note)
-
-        # Dropped Metrics Note Slide
-        utils.verbose_print("Adding dropped metrics note slide...")
-        fig, ax = plt.subplots(figsize=(11, 8.5))
-        utils.place_logo_on_figure(fig)
-        ax.axis('off')
-        ax.set_title("Additional Information", fontsize=22, color=utils.UCSB_BLUE, pad=20)
-        ax.text(0.05, 0.85, note, ha='left', va='top', fontsize=16, color=utils.UCSB_BLUE)
-        utils.add_slide_number(fig)
-        pdf.savefig(fig, bbox_inches='tight')
-        plt.close(fig)
-
-        # Summary Table Slide (Overall KPIs)
-        utils.verbose_print("Generating summary table slide...")
-        summary_df = analysis.create_summary_table(df)
-        visualization.create_summary_table_slide(summary_df, pdf)
-
-        # Compute rate columns for further analysis
-        df_rates = analysis.compute_rate_columns(df)
-
-        # Correlation Heatmap Slide
-        utils.verbose_print("Generating correlation heatmap slide...")
-        visualization.create_correlation_heatmap(df_rates, pdf, client)
-
-        # Distribution Histograms for key metrics
-        for metric in ["Delivery Rate", "Open Rate", "Click Rate", "Bounce Rate", "Unsubscribe Rate"]:
-            utils.verbose_print(f"Generating distribution histogram for {metric}...")
-            visualization.create_distribution_histogram(df_rates, metric, pdf, client)
-
-        # Final Overall Conclusion Slide
-        utils.verbose_print("Generating final overall conclusion slide...")
-        visualization.create_overall_conclusion(summary_df, pdf, client)
-
+    summary = analysis.create_summary_table(df)
+
+    # Compute rate columns for further analysis
+    df_rates = analysis.compute_rate_columns(df)
+    corr_mat, corr_cols, corr_text = analysis.correlation_summary(df_rates)
+
+    # AI prompts for every chart; they are sent once the chart workers are running
+    chart_tasks = {"Correlation Heatmap": (f"Correlation Data:\n{corr_text}", "Correlation Heatmap")}
+    for metric in analysis.RATE_COLUMNS:
+        summary_text = analysis.describe_rate(df_rates, metric)
+        chart_tasks[metric] = (f"Distribution Summary for {metric}:\n{summary_text}", f"Histogram for {metric}")
+
+    # Semantic cache hits are limited to reports on the same campaigns
+    dataset = analysis.dataset_fingerprint(df)
+
+    deck = utils.SlideDeck(visualization.FIGSIZE)
+
+    # Title Slide
+    utils.verbose_print("Generating title slide...")
+    _, ax = deck.text_slide()
+    ax.set_title("Zoho Campaign Performance", fontproperties=utils.slide_font(30), color=utils.UCSB_BLUE, pad=20)
+    ax.text(0.5, 0.55, "A Data-Driven Look at Email Marketing Results", fontproperties=utils.slide_font(18), ha='center', color=utils.PACE_LINKS)
+    deck.add()
+
+    # Definitions Slide
+    utils.verbose_print("Generating definitions slide...")
+    visualization.create_definitions_additional_slide(deck, note)
+
+    # Dropped Metrics Note Slide
+    utils.verbose_print("Adding dropped metrics note slide...")
+    _, ax = deck.text_slide()
+    ax.set_title("Additional Information", fontproperties=utils.slide_font(22), color=utils.UCSB_BLUE, pad=20)
+    ax.text(0.05, 0.85, note, ha='left', va='top', fontproperties=utils.slide_font(16), color=utils.UCSB_BLUE)
+    deck.add()
+
+    # Summary Table Slide (Overall KPIs)
+    utils.verbose_print("Generating summary table slide...")
+    visualization.create_summary_table_slide(summary, deck)
+
+    # Correlation heatmap and distribution histograms, each followed by its insights slide.
+    # Slide numbers are reserved in document order so chart pages can render in worker processes.
+    chart_jobs = {"Correlation Heatmap": (visualization.build_correlation_heatmap, (corr_mat, corr_cols))}
+    insight_titles = {"Correlation Heatmap": "Insights for Correlation Heatmap"}
+    for metric in analysis.RATE_COLUMNS:
+        chart_jobs[metric] = (visualization.build_distribution_histogram, (df_rates[[metric]], metric))
+        insight_titles[metric] = f"Insights for Distribution of {metric}"
+    chart_numbers = {}
+    insight_numbers = {}
+    for name in chart_jobs:
+        chart_numbers[name] = deck.reserve()
+        insight_numbers[name] = deck.reserve()
+
+    utils.verbose_print("Rendering chart slides and requesting AI explanations...")
+    # A worker pool only pays off with several CPUs. Pages rendered in workers are
+    # merged as separate PDFs that each embed their own font subset, which makes the
+    # report larger, so a single-CPU run draws the charts here into the shared stream.
+    use_pool = not args.singlecore and (os.cpu_count() or 1) > 1 and len(chart_jobs) > 1
+    if use_pool:
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(chart_jobs))) as pool:
+            chart_futures = {
+                name: pool.submit(visualization.render_chart_page, builder, builder_args, chart_numbers[name])
+                for name, (builder, builder_args) in chart_jobs.items()
+            }
+            explanations, overall_text = openai_integration.generate_all_explanations(
+                client, chart_tasks, analysis.format_summary_table(summary), dataset)
+            for name, future in chart_futures.items():
+                deck.add_page(chart_numbers[name], future.result())
+    else:
+        explanations, overall_text = openai_integration.generate_all_explanations(
+            client, chart_tasks, analysis.format_summary_table(summary), dataset)
+        for name, (builder, builder_args) in chart_jobs.items():
+            deck.add_chart(builder(*builder_args), chart_numbers[name])
+
+    for name in chart_jobs:
+        visualization.create_insights_slide(insight_titles[name], explanations[name], deck, insight_numbers[name])
+
+    # Final Overall Conclusion Slide
+    utils.verbose_print("Generating final overall conclusion slide...")
+    visualization.create_overall_conclusion(overall_text, deck)
+
+    deck.write(args.output)
+    utils.prune_slide_cache()
     utils.verbose_print(f"PDF report successfully created: {args.output}")
 
 if __name__ == "__main__":
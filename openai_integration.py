@@ -1,54 +1,229 @@
 # openai_integration.py
 import os
+import re
 import json
+import asyncio
+import sqlite3
 import hashlib
+import time
+import numpy as np
 from utils import verbose_print
 
-CACHE_FILE = "ai_cache.json"
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def load_cache():
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-    return {}
+# Resolved once at import; drivers load .env before importing this module
+ENGINE_MODEL = os.getenv("ENGINE_MODEL", "gpt-4o")
+# Year the industry-standard statistics in the prompts should come from
+YEAR = os.getenv("YEAR", "2025")
 
-def save_cache(cache):
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+CACHE_FILE = "ai_cache.sqlite"
+# Cached responses older than this many seconds are requested again
+CACHE_TTL = 86400
 
-def get_cache_key(data_description, chart_type):
-    key = data_description + chart_type
-    return hashlib.md5(key.encode("utf-8")).hexdigest()
+SEMANTIC_CACHE_DIR = os.path.join(".pace_cache", "semantic")
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Minimum cosine similarity for a semantic cache hit
+SIMILARITY_THRESHOLD = 0.95
+# Numbers in a data context; only these are embedded, since its labels are the same for every dataset
+NUMBER_PATTERN = re.compile(r"-?\d+(?:\.\d+)?")
 
-def generate_full_explanation(client, data_description, chart_type):
+_CONN = None
+
+def get_connection():
+    """
+    Opens the SQLite cache on first use and returns the shared connection.
+    All cache access happens on the event-loop thread, so no locking is needed.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = sqlite3.connect(CACHE_FILE)
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute("CREATE TABLE IF NOT EXISTS responses(k TEXT PRIMARY KEY, v TEXT, created REAL)")
+        # cache_get already ignores expired rows; delete them so the file does not keep growing
+        _CONN.execute("DELETE FROM responses WHERE created<?", (time.time() - CACHE_TTL,))
+        _CONN.commit()
+    return _CONN
+
+def cache_get(key):
+    row = get_connection().execute(
+        "SELECT v FROM responses WHERE k=? AND created>?", (key, time.time() - CACHE_TTL)
+    ).fetchone()
+    return row[0] if row else None
+
+def cache_set(key, value):
+    conn = get_connection()
+    conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, value, time.time()))
+    conn.commit()
+
+def get_cache_key(model, prompt, kind):
+    key = "\0".join((model, prompt, kind))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16, usedforsecurity=False).hexdigest()
+
+class SemanticCache:
+    """
+    Nearest-neighbour cache of AI responses keyed by unit-length embeddings of the
+    numbers in a prompt's data context, so figures that drifted slightly since the
+    last run reuse that response.
+    Entries only ever match prompts of the same kind, model and dataset fingerprint,
+    and expire after CACHE_TTL like the exact cache.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.embeddings = None
+        self.entries = None
+        self.dirty = False
+
+    def _paths(self):
+        return (os.path.join(self.directory, "embeddings.npy"),
+                os.path.join(self.directory, "entries.json"))
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        embeddings_path, entries_path = self._paths()
+        if os.path.exists(embeddings_path) and os.path.exists(entries_path):
+            self.embeddings = np.load(embeddings_path)
+            with open(entries_path, "rb") as f:
+                data = f.read()
+            self.entries = orjson.loads(data) if orjson else json.loads(data)
+            # The two files are replaced one after the other; start over if a crash split them
+            if len(self.entries) != self.embeddings.shape[0]:
+                verbose_print("Semantic cache files are out of step; starting an empty cache.")
+                self.embeddings = None
+                self.entries = []
+                return
+            # Drop expired entries so the cache does not grow without bound
+            cutoff = time.time() - CACHE_TTL
+            fresh = [i for i, e in enumerate(self.entries) if e.get("created", 0) > cutoff]
+            if len(fresh) < len(self.entries):
+                self.embeddings = self.embeddings[fresh]
+                self.entries = [self.entries[i] for i in fresh]
+                self.dirty = True
+        else:
+            self.entries = []
+
+    def lookup(self, embedding, model, kind, dataset):
+        self._load()
+        if not self.entries:
+            return None
+        similarities = self.embeddings @ embedding
+        cutoff = time.time() - CACHE_TTL
+        matches = np.array([e["model"] == model and e["kind"] == kind and e.get("dataset") == dataset
+                            and e["created"] > cutoff for e in self.entries])
+        similarities = np.where(matches, similarities, -1.0)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= SIMILARITY_THRESHOLD:
+            return self.entries[best]["response"]
+        return None
+
+    def add(self, embedding, model, kind, dataset, prompt, response):
+        self._load()
+        row = embedding[np.newaxis, :]
+        self.embeddings = np.vstack([self.embeddings, row]) if self.entries else row
+        self.entries.append({"model": model, "kind": kind, "dataset": dataset, "prompt": prompt,
+                             "response": response, "created": time.time()})
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        embeddings_path, entries_path = self._paths()
+        if not self.entries:
+            # Every entry expired; remove both files rather than saving an empty array
+            for path in (embeddings_path, entries_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.dirty = False
+            return
+        data = orjson.dumps(self.entries) if orjson else json.dumps(self.entries).encode("utf-8")
+        # Write each file under a temporary name and rename it into place
+        with open(embeddings_path + ".tmp", "wb") as f:
+            np.save(f, self.embeddings)
+        with open(entries_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+        os.replace(entries_path + ".tmp", entries_path)
+        self.dirty = False
+
+_SEMANTIC_CACHE = SemanticCache(SEMANTIC_CACHE_DIR)
+
+async def embed_text(client, text):
+    """
+    Returns the unit-length embedding of text, or None if the embedding call fails.
+    """
+    try:
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    except Exception as e:
+        verbose_print(f"Context embedding failed, skipping semantic cache: {e}")
+        return None
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+async def cached_response(client, prompt, kind, context=None, dataset=None):
+    """
+    Returns the model's output text for prompt, serving it from the cache when the
+    same (model, prompt, kind) was answered within CACHE_TTL, or from the semantic
+    cache when the same dataset had near-identical numbers in context for the same
+    kind within CACHE_TTL. context is the data part of prompt and dataset a fingerprint
+    of which campaigns it describes; without both only the exact cache is used.
+    Semantic hits are not copied into the exact cache, so they cannot outlive it.
+    Only successful responses are cached; API errors propagate to the caller.
+    """
+    model = ENGINE_MODEL
+    key = get_cache_key(model, prompt, kind)
+    cached = cache_get(key)
+    if cached is not None:
+        verbose_print(f"Using cached AI response for {kind}.")
+        return cached
+    numbers = " ".join(NUMBER_PATTERN.findall(context)) if context else ""
+    embedding = await embed_text(client, numbers) if client and numbers and dataset else None
+    if embedding is not None:
+        similar = _SEMANTIC_CACHE.lookup(embedding, model, kind, dataset)
+        if similar is not None:
+            verbose_print(f"Using semantically cached AI response for {kind}.")
+            return similar
+    # Stream the output so the connection is read while the model is still generating
+    stream = await client.responses.create(
+        model=model,
+        input=prompt,
+        stream=True
+    )
+    parts = []
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            parts.append(event.delta)
+        elif event.type in ("error", "response.failed"):
+            raise RuntimeError(getattr(event, "message", None) or f"{kind} response failed")
+    text = "".join(parts).strip()
+    cache_set(key, text)
+    if embedding is not None:
+        _SEMANTIC_CACHE.add(embedding, model, kind, dataset, prompt, text)
+    return text
+
+async def generate_full_explanation(client, data_description, chart_type, dataset=None):
     """
     Generates an explanation with the following structure:
       - Overview: one short paragraph explaining what the chart shows.
       - AI Insights: three bullet points.
       - Recommendations: two bullet points.
-      - Industry Standards: web-sourced 2025 statistics with embedded links.
-    
-    This function first checks if a cached result exists for the given data_description and chart_type.
-    If so, it returns the cached response; otherwise, it calls the AI, caches the result, and returns it.
-    """
-    cache = load_cache()
-    key = get_cache_key(data_description, chart_type)
-    if key in cache:
-        verbose_print("Using cached AI explanation.")
-        return cache[key]
+      - Industry Standards: web-sourced statistics for YEAR with embedded links.
     
+    Identical requests are served from the response cache, and near-identical figures
+    for the same dataset from the semantic cache. The fixed instructions
+    come first and the chart data last, so OpenAI's server-side prompt caching can
+    reuse the shared prefix across charts.
+    """
     prompt = f"""
-You are a marketing analytics expert. Analyze the following data context and chart type.
-Data Context: {data_description}
-Chart Type: {chart_type}
+You are a marketing analytics expert. Analyze the data context and chart type given at the end.
 Generate an explanation that includes:
 1. An overview in one short paragraph explaining what the chart shows.
 2. Three bullet points with AI Insights.
 3. Two bullet points with Recommendations.
-4. Industry Standards: Use web search to source relevant 2025 statistics and embed the source link.
+4. Industry Standards: Use web search to source relevant {YEAR} statistics and embed the source link.
 Format your response exactly as follows:
 
 Overview: <your overview>
@@ -66,16 +241,70 @@ Industry Standards:
 <your sourced statistics with citation>
 
 Respond in plain text.
+
+Chart Type: {chart_type}
+Data Context: {data_description}
     """.strip()
     try:
-        response = client.responses.create(
-            model="gpt-4o",
-            input=prompt
-        )
-        explanation = response.output_text.strip()
+        return await cached_response(client, prompt, chart_type, data_description, dataset)
     except Exception as e:
-        explanation = f"Error in generating explanation: {e}"
-    
-    cache[key] = explanation
-    save_cache(cache)
-    return explanation
+        return f"Error in generating explanation: {e}"
+
+async def generate_overall_conclusion(client, raw_summary):
+    """
+    Generates the overall conclusion text for the summary KPI table.
+    Only exact repeats are served from the cache: the table is mostly fixed labels
+    and its totals say nothing about which campaigns they came from.
+    """
+    prompt = f"""
+As a marketing analytics expert, provide an overall conclusion for the email marketing KPI summary given at the end, with:
+- An overview paragraph.
+- Three bullet points for AI Insights.
+- Two bullet points for Recommendations.
+- Industry Standards with embedded source links.
+Respond in plain text with the order: Overview, AI Insights, Recommendations, Industry Standards.
+
+KPI summary:
+{raw_summary}
+    """.strip()
+    if not client:
+        return "AI client not available. No overall conclusion generated."
+    try:
+        return await cached_response(client, prompt, "Overall Conclusion")
+    except Exception as e:
+        return f"Error in AI call: {e}"
+
+async def gather_explanations(client, chart_tasks, raw_summary, dataset=None, max_concurrency=8):
+    """
+    Awaits every chart explanation and the overall conclusion together, with at most
+    max_concurrency requests in flight to stay within API rate limits. The client's
+    connection pool is closed before returning, while its event loop is still running.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    names = list(chart_tasks)
+    try:
+        results = await asyncio.gather(
+            *(limited(generate_full_explanation(client, *chart_tasks[name], dataset)) for name in names),
+            limited(generate_overall_conclusion(client, raw_summary)),
+        )
+    finally:
+        if client:
+            await client.close()
+    return dict(zip(names, results[:-1])), results[-1]
+
+def generate_all_explanations(client, chart_tasks, raw_summary, dataset=None, max_concurrency=8):
+    """
+    Requests every chart explanation and the overall conclusion concurrently on an
+    AsyncOpenAI client. chart_tasks maps a name to its (data_description, chart_type) pair;
+    dataset fingerprints the campaigns they describe (see analysis.dataset_fingerprint).
+    Returns the explanations keyed like chart_tasks, plus the overall conclusion text.
+    """
+    explanations, overall_text = asyncio.run(
+        gather_explanations(client, chart_tasks, raw_summary, dataset, max_concurrency))
+    _SEMANTIC_CACHE.save()
+    return explanations, overall_text
@@ -1,15 +1,39 @@
 # utils.py
+import io
 import os
+import time
+import hashlib
+import functools
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.font_manager import FontProperties
 import markdown
+from pypdf import PdfReader, PdfWriter
 
 # Branding and global configuration
 UCSB_BLUE = "#003660"
 UCSB_GOLD = "#febc11"
 PACE_LINKS = "#1178b5"
 
-# Global slide counter
-SLIDE_NUMBER = 1
+# Fixed chart-slide margins, used instead of a tight bbox pass that renders each chart twice.
+# The top margin leaves the logo corner (y >= 0.85) clear of the axes. Text slides keep the
+# tight bbox so that long wrapped AI text grows the page instead of being cut off.
+SLIDE_MARGINS = dict(left=0.08, right=0.95, top=0.83, bottom=0.08)
+
+LOGO_FILE = "logo.png"
+
+# Rendered single-page PDFs, keyed by a hash of everything the page is drawn from.
+# Pages unused for SLIDE_CACHE_MAX_AGE seconds are pruned; delete the directory to clear it.
+SLIDE_CACHE_DIR = os.path.join(".pace_cache", "slides")
+SLIDE_CACHE_MAX_AGE = 30 * 86400
+# Bump when slide drawing code changes so cached pages are re-rendered
+SLIDE_CACHE_VERSION = b"v3"
+# rcParams that change how a cached page is drawn or embedded
+SLIDE_CACHE_RCPARAMS = ("pdf.fonttype", "font.family", "font.sans-serif",
+                        "path.simplify_threshold", "savefig.dpi")
+
+# Shared Markdown converter; reset() between documents avoids rebuilding the parser
+_MD = markdown.Markdown(output_format="html5", extensions=[])
 
 def verbose_print(message):
     print("[INFO] " + message)
@@ -19,37 +43,236 @@ def process_markdown(text):
     Converts markdown text to HTML.
     """
     try:
-        html = markdown.markdown(text)
+        html = _MD.reset().convert(text)
         return html
     except Exception as e:
         verbose_print(f"Markdown conversion failed: {e}")
         return text
 
-def add_slide_number(fig):
+@functools.lru_cache(maxsize=None)
+def slide_font(size):
+    """
+    Returns the DejaVu Sans FontProperties for a text size, built once per size
+    and shared by every text slide.
+    """
+    return FontProperties(family="DejaVu Sans", size=size)
+
+def stamp_slide_number(fig, number):
+    """
+    Adds the slide number to the figure, consistently positioned at bottom-right.
+    Returns the text artist so a reused figure can update it with set_text.
+    """
+    return fig.text(0.95, 0.02, f"Slide {number}", ha="right", va="bottom", fontproperties=slide_font(10), color=UCSB_BLUE)
+
+def figure_to_pdf(fig, tight=False):
+    """
+    Renders the figure as a single-page PDF and returns its bytes. With tight=True
+    the page is fitted to everything drawn, including text past the figure edge.
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format="pdf", bbox_inches="tight" if tight else None)
+    return buf.getvalue()
+
+def _render_settings():
+    """
+    Describes the environment a page is rendered in: the logo file's mtime and
+    size (None when it is missing) and the SLIDE_CACHE_RCPARAMS values.
+    """
+    try:
+        stat = os.stat(os.path.join(os.getcwd(), LOGO_FILE))
+        logo = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        logo = None
+    return repr((logo, [plt.rcParams[name] for name in SLIDE_CACHE_RCPARAMS]))
+
+def slide_cache_key(*parts):
+    """
+    Hashes the inputs a slide is drawn from, plus the logo and rendering settings,
+    into its cache key. Parts that are not bytes are hashed by their str().
+    """
+    digest = hashlib.sha256()
+    for part in (*parts, _render_settings()):
+        data = part if isinstance(part, bytes) else str(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    digest.update(SLIDE_CACHE_VERSION)
+    return digest.hexdigest()
+
+def load_cached_slide(key):
+    """
+    Returns the cached PDF page for key, or None if it has not been rendered before.
+    A hit refreshes the page's mtime so prune_slide_cache keeps it.
+    """
+    path = os.path.join(SLIDE_CACHE_DIR, f"{key}.pdf")
+    try:
+        with open(path, "rb") as f:
+            page = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+    return page
+
+def store_cached_slide(key, page):
+    """
+    Writes a rendered PDF page to the slide cache. The file is renamed into place
+    so concurrent workers never read a partial page.
+    """
+    os.makedirs(SLIDE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(SLIDE_CACHE_DIR, f"{key}.pdf")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(page)
+    os.replace(tmp_path, path)
+
+def prune_slide_cache(max_age=SLIDE_CACHE_MAX_AGE):
+    """
+    Deletes cached slide pages that have not been written or used for max_age seconds.
+    """
+    if not os.path.isdir(SLIDE_CACHE_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(SLIDE_CACHE_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+class SlideDeck:
+    """
+    Collects numbered report slides and writes them out in slide order, so pages
+    rendered elsewhere (e.g. in worker processes) can be slotted in by number.
+    Text slides are all drawn on one shared figure that is cleared between pages.
+    Slides drawn in this process are saved into a single PdfPages stream so they share
+    one embedded font subset; merging separate one-page PDFs would embed the font
+    again on every page (roughly 10 KB each).
+    """
+    def __init__(self, figsize=(11, 8.5)):
+        self.pages = {}
+        self.n = 0
+        self.figsize = figsize
+        self.text_fig = None
+        self.text_ax = None
+        self.text_number = None
+        self.stream_buffer = io.BytesIO()
+        self.stream = None
+        # Slide number of each page in stream, in the order they were saved
+        self.stream_numbers = []
+
+    def text_slide(self):
+        """
+        Returns the shared text-slide figure and axes, cleared for a new page.
+        The figure, its logo and its slide-number artist are created on first use.
+        """
+        if self.text_fig is None:
+            self.text_fig, self.text_ax = plt.subplots(figsize=self.figsize)
+            place_logo_on_figure(self.text_fig)
+            self.text_number = stamp_slide_number(self.text_fig, "")
+        reset_text_slide(self.text_fig, self.text_ax, keep=(self.text_number,))
+        return self.text_fig, self.text_ax
+
+    def reserve(self):
+        """
+        Claims the next slide number for a page that will be added later.
+        """
+        self.n += 1
+        return self.n
+
+    def add(self, number=None):
+        """
+        Renders the current text slide under its slide number (the next one unless given).
+        Chart pages are rendered elsewhere and come in through add_page.
+        """
+        if number is None:
+            number = self.reserve()
+        self.text_number.set_text(f"Slide {number}")
+        self._save_to_stream(self.text_fig, number, bbox_inches="tight")
+
+    def add_chart(self, fig, number):
+        """
+        Stamps the slide number on a chart figure built in this process and saves it
+        into the shared stream under that number.
+        """
+        stamp_slide_number(fig, number)
+        self._save_to_stream(fig, number)
+
+    def _save_to_stream(self, fig, number, **kwargs):
+        if self.stream is None:
+            self.stream = PdfPages(self.stream_buffer)
+        self.stream.savefig(fig, **kwargs)
+        self.stream_numbers.append(number)
+
+    def add_standalone(self, number):
+        """
+        Renders the current text slide as its own single-page PDF, adds it under number
+        and returns its bytes, for pages that are also kept in the slide cache.
+        """
+        self.text_number.set_text(f"Slide {number}")
+        page = figure_to_pdf(self.text_fig, tight=True)
+        self.add_page(number, page)
+        return page
+
+    def add_page(self, number, page):
+        """
+        Adds an already rendered single-page PDF under a reserved slide number.
+        """
+        self.pages[number] = page
+
+    def write(self, path):
+        if self.text_fig is not None:
+            plt.close(self.text_fig)
+            self.text_fig = self.text_ax = self.text_number = None
+        stream_pages = {}
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+            stream_pages = dict(zip(self.stream_numbers, PdfReader(self.stream_buffer).pages))
+        writer = PdfWriter()
+        for number in sorted(self.pages.keys() | stream_pages.keys()):
+            if number in stream_pages:
+                writer.add_page(stream_pages[number])
+            else:
+                writer.append(io.BytesIO(self.pages[number]))
+        with open(path, "wb") as f:
+            writer.write(f)
+
+def reset_text_slide(fig, ax, keep=()):
     """
-    Adds the current slide number to the figure (consistently positioned at bottom-right) and increments the counter.
+    Clears a reused slide figure for the next page while keeping its logo axes
+    and any figure texts listed in keep.
     """
-    global SLIDE_NUMBER
-    fig.text(0.95, 0.02, f"Slide {SLIDE_NUMBER}", ha="right", va="bottom", fontsize=10, color=UCSB_BLUE)
-    SLIDE_NUMBER += 1
+    ax.clear()
+    ax.axis('off')
+    for text in list(fig.texts):
+        if text not in keep:
+            text.remove()
 
 def init_openai_client(openai_module, api_key):
     """
-    Initializes and returns the OpenAI client if available; otherwise returns None.
+    Initializes and returns the async OpenAI client if available; otherwise returns None.
     """
     if openai_module is None or not api_key:
         verbose_print("OpenAI client not configured. Comments will be skipped.")
         return None
-    client = openai_module.OpenAI(api_key=api_key)
+    client = openai_module.AsyncOpenAI(api_key=api_key)
     return client
 
-def place_logo_on_figure(fig, logo_path="logo.png"):
+@functools.lru_cache(maxsize=4)
+def _load_logo(path, mtime, size):
+    """
+    Decodes the logo image once per path; imshow only reads the returned array.
+    mtime and size are part of the cache key so a replaced file is decoded again.
+    """
+    return plt.imread(path)
+
+def place_logo_on_figure(fig, logo_path=LOGO_FILE):
     """
     Places a small logo in the top-right corner of the figure using an absolute path.
     """
     try:
         full_path = os.path.join(os.getcwd(), logo_path)
-        logo_img = plt.imread(full_path)
+        stat = os.stat(full_path)
+        logo_img = _load_logo(full_path, stat.st_mtime_ns, stat.st_size)
         new_ax = fig.add_axes([0.85, 0.85, 0.1, 0.1], anchor='NE', zorder=1)
         new_ax.imshow(logo_img)
         new_ax.axis('off')
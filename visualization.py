@@ -1,25 +1,33 @@
 # visualization.py
-import matplotlib.pyplot as plt
-import seaborn as sns
-import dataframe_image as dfi
-from utils import UCSB_BLUE, PACE_LINKS, add_slide_number, place_logo_on_figure, process_markdown
-from openai_integration import generate_full_explanation
-import os
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from analysis import SUMMARY_COLUMNS, frame_fingerprint
+from utils import (UCSB_BLUE, PACE_LINKS, SLIDE_MARGINS, place_logo_on_figure, process_markdown,
+                   slide_font, stamp_slide_number, figure_to_pdf,
+                   slide_cache_key, load_cached_slide, store_cached_slide)
 
 # Use uniform letter-size landscape (11 x 8.5 inches)
 FIGSIZE = (11, 8.5)
 
-def create_summary_table_slide(summary_df, pdf):
+def create_summary_table_slide(summary, deck):
     """
     Generates a slide with a styled table of key email marketing metrics.
+    The rendered page is reused from the slide cache when the summary is unchanged.
     """
-    fig, ax = plt.subplots(figsize=FIGSIZE)
+    number = deck.reserve()
+    cache_key = slide_cache_key("summary table", number, repr(summary))
+    page = load_cached_slide(cache_key)
+    if page is not None:
+        deck.add_page(number, page)
+        return
+
+    _, ax = deck.text_slide()
     ax.axis('tight')
-    ax.axis('off')
-    ax.set_title("Key Email Marketing Metrics", fontsize=24, color=UCSB_BLUE, pad=20)
+    ax.set_title("Key Email Marketing Metrics", fontproperties=slide_font(24), color=UCSB_BLUE, pad=20)
     
-    table = ax.table(cellText=summary_df.values,
-                     colLabels=summary_df.columns,
+    table = ax.table(cellText=summary,
+                     colLabels=SUMMARY_COLUMNS,
                      loc='center',
                      cellLoc='center')
     table.auto_set_font_size(False)
@@ -31,68 +39,109 @@ def create_summary_table_slide(summary_df, pdf):
             cell.set_facecolor(PACE_LINKS)
     table.scale(1, 2)
     
-    place_logo_on_figure(fig)
-    add_slide_number(fig)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    store_cached_slide(cache_key, deck.add_standalone(number))
 
-def create_correlation_heatmap(df_rates, pdf, client):
+def build_correlation_heatmap(corr_mat, corr_cols):
     """
-    Creates a correlation heatmap slide and an insights text slide.
+    Builds the correlation heatmap figure without numbering or saving it.
+    Uses the Figure API rather than pyplot so it does not depend on pyplot state.
     """
-    rate_cols = ["Delivery Rate", "Open Rate", "Click Rate", "Bounce Rate", "Unsubscribe Rate"]
-    corr = df_rates[rate_cols].corr()
-
-    # Heatmap slide
-    fig, ax = plt.subplots(figsize=FIGSIZE)
+    import seaborn as sns  # deferred until a chart is actually built
+    fig = Figure(figsize=FIGSIZE)
+    ax = fig.subplots()
+    fig.subplots_adjust(**SLIDE_MARGINS)
     place_logo_on_figure(fig)
-    sns.heatmap(corr, annot=True, fmt=".2f", cmap="coolwarm", ax=ax)
+    # Format every annotation in one vectorized call instead of per cell
+    annot = np.char.mod("%.2f", corr_mat)
+    # Rasterize the colour mesh; the annotations and labels stay vector text
+    sns.heatmap(corr_mat, xticklabels=corr_cols, yticklabels=corr_cols,
+                annot=annot, fmt="", cmap="coolwarm", rasterized=True, ax=ax)
     ax.set_title("Correlation Heatmap for Key Email Marketing Rates", fontsize=18, color=UCSB_BLUE)
-    add_slide_number(fig)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    return fig
 
-    # Insights text slide
-    raw_data_text = corr.to_string()
-    ai_explanation = generate_full_explanation(client, f"Correlation Data:\n{raw_data_text}", "Correlation Heatmap")
-    fig, ax = plt.subplots(figsize=FIGSIZE)
-    place_logo_on_figure(fig)
-    ax.axis('off')
-    # Consistent title and positioning for text slides:
-    ax.text(0.05, 0.90, "Insights for Correlation Heatmap", fontsize=20, color=UCSB_BLUE)
-    add_slide_number(fig)
-    ax.text(0.05, 0.80, ai_explanation, ha='left', va='top', wrap=True, fontsize=12, color=UCSB_BLUE)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+def kde_curve(data, points=200):
+    """
+    Evaluates a Gaussian KDE with Scott's bandwidth on an evenly spaced grid over
+    the data range. The data is binned onto the grid first, so the cost stays
+    O(N + points²) however many campaigns there are.
+    Returns (xs, density), or None when the data has fewer than two distinct values.
+    """
+    if data.size < 2:
+        return None
+    bandwidth = data.std(ddof=1) * data.size ** (-1 / 5)
+    if not bandwidth > 0:
+        return None
+    weights, edges = np.histogram(data, bins=points)
+    xs = (edges[:-1] + edges[1:]) / 2
+    z = (xs[:, np.newaxis] - xs[np.newaxis, :]) / bandwidth
+    density = np.exp(-0.5 * z * z) @ weights / (data.size * bandwidth * np.sqrt(2 * np.pi))
+    return xs, density
 
-def create_distribution_histogram(df_rates, metric, pdf, client):
+def build_distribution_histogram(df_rates, metric):
     """
-    Creates a histogram slide for a given metric and an insights text slide.
+    Builds the histogram figure for a given metric without numbering or saving it.
+    Uses the Figure API rather than pyplot so it does not depend on pyplot state.
     """
-    # Histogram slide
-    fig, ax = plt.subplots(figsize=FIGSIZE)
+    fig = Figure(figsize=FIGSIZE)
+    ax = fig.subplots()
+    fig.subplots_adjust(**SLIDE_MARGINS)
     place_logo_on_figure(fig)
-    sns.histplot(df_rates[metric].dropna(), kde=True, color=PACE_LINKS, ax=ax)
+    data = df_rates[metric].dropna().to_numpy(dtype=np.float64)
+    counts, edges = np.histogram(data, bins="auto")
+    # Embed the bars as one image rather than a vector path per bin
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge", color=PACE_LINKS,
+           alpha=0.5, edgecolor=UCSB_BLUE, linewidth=0.8, rasterized=True)
+    curve = kde_curve(data)
+    if curve is not None:
+        xs, density = curve
+        # Scale the density to counts per bin so the curve follows the bars
+        ax.plot(xs, density * data.size * np.diff(edges).mean(), color=PACE_LINKS)
     ax.set_title(f"Distribution of {metric}", fontsize=18, color=UCSB_BLUE)
     ax.set_xlabel(metric, fontsize=14, color=UCSB_BLUE)
     ax.set_ylabel("Frequency (Count per bin)", fontsize=14, color=UCSB_BLUE)
-    add_slide_number(fig)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    return fig
 
-    # Insights text slide
-    summary_text = df_rates[metric].describe().to_string()
-    ai_explanation = generate_full_explanation(client, f"Distribution Summary for {metric}:\n{summary_text}", f"Histogram for {metric}")
-    fig, ax = plt.subplots(figsize=FIGSIZE)
-    place_logo_on_figure(fig)
-    ax.axis('off')
-    ax.text(0.05, 0.90, f"Insights for Distribution of {metric}", fontsize=20, color=UCSB_BLUE)
-    add_slide_number(fig)
-    ax.text(0.05, 0.80, ai_explanation, ha='left', va='top', wrap=True, fontsize=12, color=UCSB_BLUE)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+def chart_cache_key(builder, args, slide_number):
+    """
+    Hashes the chart builder, its arguments and the slide number into the key
+    its rendered page is cached under.
+    """
+    parts = [builder.__name__, slide_number]
+    for arg in args:
+        if isinstance(arg, pd.DataFrame):
+            parts += [list(arg.columns), frame_fingerprint(arg)]
+        elif isinstance(arg, np.ndarray):
+            parts += [arg.shape, arg.tobytes()]
+        else:
+            parts.append(arg)
+    return slide_cache_key(*parts)
 
-def create_definitions_additional_slide(pdf, note):
+def render_chart_page(builder, args, slide_number):
+    """
+    Builds a chart figure with builder(*args), stamps its slide number and returns
+    it as single-page PDF bytes, skipping matplotlib entirely when the same chart
+    was rendered on an earlier run. Runs in a worker process.
+    """
+    key = chart_cache_key(builder, args, slide_number)
+    page = load_cached_slide(key)
+    if page is None:
+        fig = builder(*args)
+        stamp_slide_number(fig, slide_number)
+        page = figure_to_pdf(fig)
+        store_cached_slide(key, page)
+    return page
+
+def create_insights_slide(title, ai_explanation, deck, number=None):
+    """
+    Creates a text slide with the AI explanation for a chart.
+    """
+    _, ax = deck.text_slide()
+    # Consistent title and positioning for text slides:
+    ax.text(0.05, 0.90, title, fontproperties=slide_font(20), color=UCSB_BLUE)
+    ax.text(0.05, 0.80, ai_explanation, ha='left', va='top', wrap=True, fontproperties=slide_font(12), color=UCSB_BLUE)
+    deck.add(number)
+
+def create_definitions_additional_slide(deck, note):
     """
     Combines Key Definitions and Additional Information into a single slide.
     """
@@ -106,52 +155,20 @@ def create_definitions_additional_slide(pdf, note):
         "• Unsubscribe Rate: (Unsubscribes / Sent) * 100\n\n"
         "Additional Information:\n" + note
     )
-    fig, ax = plt.subplots(figsize=FIGSIZE)
-    place_logo_on_figure(fig)
-    ax.axis('off')
-    ax.text(0.05, 0.90, "Key Definitions & Additional Information", fontsize=24, color=UCSB_BLUE)
-    add_slide_number(fig)
-    ax.text(0.05, 0.75, definitions, ha='left', va='top', wrap=True, fontsize=14, color=UCSB_BLUE)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    _, ax = deck.text_slide()
+    ax.text(0.05, 0.90, "Key Definitions & Additional Information", fontproperties=slide_font(24), color=UCSB_BLUE)
+    ax.text(0.05, 0.75, definitions, ha='left', va='top', wrap=True, fontproperties=slide_font(14), color=UCSB_BLUE)
+    deck.add()
 
-def create_overall_conclusion(summary_df, pdf, client):
+def create_overall_conclusion(overall_text, deck):
     """
-    Generates the overall conclusions slide using AI-generated insights.
+    Generates the overall conclusions slide from the AI-generated conclusion text.
     Processes markdown so that any formatting is interpreted as plain text.
     """
-    raw_summary = summary_df.to_string(index=False)
-    prompt = f"""
-We have the following summary of our email marketing KPIs:
-{raw_summary}
-
-As a marketing analytics expert, provide an overall conclusion with:
-- An overview paragraph.
-- Three bullet points for AI Insights.
-- Two bullet points for Recommendations.
-- Industry Standards with embedded source links.
-Respond in plain text with the order: Overview, AI Insights, Recommendations, Industry Standards.
-    """.strip()
-    if client:
-        try:
-            initial_response = client.responses.create(
-                model=os.getenv("ENGINE_MODEL", "gpt-4o"),
-                input=prompt
-            )
-            overall_text = initial_response.output_text.strip()
-        except Exception as e:
-            overall_text = f"Error in AI call: {e}"
-    else:
-        overall_text = "AI client not available. No overall conclusion generated."
-    
     # Process markdown to interpret headings and links
     overall_text = process_markdown(overall_text)
     
-    fig, ax = plt.subplots(figsize=FIGSIZE)
-    place_logo_on_figure(fig)
-    ax.axis('off')
-    ax.text(0.05, 0.90, "Overall Performance Conclusions", fontsize=24, color=UCSB_BLUE)
-    add_slide_number(fig)
-    ax.text(0.05, 0.75, overall_text, ha='left', va='top', wrap=True, fontsize=12, color=UCSB_BLUE)
-    pdf.savefig(fig, bbox_inches='tight')
-    plt.close(fig)
+    _, ax = deck.text_slide()
+    ax.text(0.05, 0.90, "Overall Performance Conclusions", fontproperties=slide_font(24), color=UCSB_BLUE)
+    ax.text(0.05, 0.75, overall_text, ha='left', va='top', wrap=True, fontproperties=slide_font(12), color=UCSB_BLUE)
+    deck.add()